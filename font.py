@@ -2,6 +2,9 @@
 """Generate BMFont v3 binary (.fnt + .tga) from TTF fonts with ordered multi-font fallback."""
 
 import struct, os, glob
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import numpy as np
 from PIL import Image, ImageFont, ImageDraw
 
 try:
@@ -11,6 +14,11 @@ except ImportError:
     print("⚠ fontTools not installed; glyph coverage detection disabled.")
     print("  Install with: pip install fonttools")
 
+try:
+    from numba import njit        # optional: compiles the MaxRects packer kernels
+except ImportError:
+    njit = None
+
 # Directory containing UTF-16 LE .tsv source files
 TSV_DIR = r""
 
@@ -24,6 +32,8 @@ PADDING     = 4
 OUTPUT_DIR  = "font"
 PAGE_PREFIX = "font_"
 FONT_NAME   = "NotoSans"
+PACKER      = "shelf"       # atlas packer: "shelf" or "maxrects"
+RENDER_WORKERS = None       # glyph rasterizer processes (None → one per CPU)
 
 # Ordered font dict: for each glyph, fonts are tried top-to-bottom
 # until one provides coverage. (Python 3.7+ preserves insertion order.)
@@ -32,26 +42,55 @@ FONT_FILES = {
     # "NotoSansJP": "NotoSansJP-Regular.ttf",
 }
 
+# ── BMFont v3 Binary Layouts ──────────────────────────────────────
+BLOCK_HDR = struct.Struct('<BI')           # block type, block size
+INFO_ST   = struct.Struct('<hBBH8B')       # block 1 fixed part (font name follows)
+COMMON_ST = struct.Struct('<5H5B')         # block 2
+
+# Block 4 char record (20 bytes). Glyphs and entries are kept as arrays of
+# this dtype, so the char block is written straight from memory.
+CHAR_DTYPE = np.dtype([('id', '<u4'), ('x', '<u2'), ('y', '<u2'), ('w', '<u2'), ('h', '<u2'),
+                       ('xoff', '<i2'), ('yoff', '<i2'), ('xadv', '<i2'),
+                       ('page', 'u1'), ('chnl', 'u1')])
+assert CHAR_DTYPE.itemsize == 20, "CHAR_DTYPE must match the 20-byte BMFont char record"
+
+# TGA: 18-byte header for 32-bit uncompressed true-color, plus TGA 2.0 footer
+TGA_HDR    = struct.Struct('<BBBHHBHHHHBB')
+TGA_FOOTER = b'\x00' * 8 + b'TRUEVISION-XFILE.\x00'
+
 # ── Font Loading ──────────────────────────────────────────────────
+_FONT_CACHE = {}                  # (ttf path, size) → ImageFont, one per process
+
+
+def _get_font(path, size):
+    """Return the process-wide ImageFont for `path` at `size`, opening it once.
+    Opening by path lets FreeType map the file itself, so rasterizer processes
+    share its pages through the OS page cache."""
+    font = _FONT_CACHE.get((path, size))
+    if font is None:
+        font = _FONT_CACHE[path, size] = ImageFont.truetype(path, size)
+    return font
+
+
 def load_cmap(ttf_path):
-    """Return set of Unicode codepoints covered by a font, or None if unavailable."""
+    """Return frozenset of Unicode codepoints covered by a font, or None if unavailable."""
     if TTFont is None or not os.path.isfile(ttf_path):
         return None
     tt = TTFont(ttf_path, lazy=True)
     cmap = tt.getBestCmap()
     tt.close()
-    return set(cmap.keys()) if cmap else set()
+    return frozenset(cmap) if cmap else frozenset()
 
 
 def load_fonts():
     """Load all fonts defined in FONT_FILES in order.
-    Returns list of (name, ImageFont, cmap_or_None) tuples."""
+    Returns tuple of (name, ImageFont, cmap_or_None) tuples."""
     fonts = []
     for name, path in FONT_FILES.items():
         if not os.path.isfile(path):
             print(f"  ⚠ '{path}' ({name}) not found, skipping.")
             continue
-        font = ImageFont.truetype(path, FONT_SIZE)
+        font = _get_font(path, FONT_SIZE)
         cmap = load_cmap(path)
         info = f"  ({len(cmap)} glyphs)" if cmap else ""
         print(f"  Loaded: {path} [{name}]{info}")
@@ -59,10 +98,14 @@ def load_fonts():
 
     if not fonts:
         raise FileNotFoundError("No usable font files found. Check FONT_FILES configuration.")
-    return fonts
+    return tuple(fonts)
 
 
 # ── Charset Collection ────────────────────────────────────────────
+# Control characters (keep space) and BOM, removed from the collected charset
+DROP_CHARS = frozenset('\r\n\t\x00\ufeff')
+
+
 def build_charset():
     """Read all .tsv files (UTF-16 LE) from TSV_DIR, collect unique characters,
     ensure ASCII printable range is included, return sorted list."""
@@ -75,11 +118,8 @@ def build_charset():
     for path in tsv_files:
         with open(path, "r", encoding="utf-16-le") as f:
             text = f.read()
-        chars.update(text.lstrip("\ufeff"))
-
-    # Remove control characters (keep space)
-    for c in ('\r', '\n', '\t', '\x00'):
-        chars.discard(c)
+        chars.update(text)
+    chars -= DROP_CHARS
 
     # Always include basic ASCII printable range
     chars.update(chr(c) for c in range(0x20, 0x7F))
@@ -87,56 +127,84 @@ def build_charset():
 
 
 # ── Glyph Rendering ──────────────────────────────────────────────
-def select_font(cp, fonts):
-    """Return (name, ImageFont) for the first font covering codepoint `cp`,
-    or (None, None) if none does."""
-    for name, font, cmap in fonts:
-        if cmap is None or cp in cmap:   # cmap is None → fontTools unavailable, try blindly
-            return name, font
-    return None, None
+_SHAPE_CACHE = {}                 # (id(font), ch) → (bbox, advance), per process
 
 
-def render_glyphs(fonts, charset):
-    """Render each character with the first font that covers it.
-    Returns list of glyph dicts ready for atlas packing."""
-    glyphs = []
-    missing = []
-    fallback_usage = {}           # font_name → [chars] (non-primary only)
-    primary_name = fonts[0][0]
+def _shape(font, ch):
+    """Return (font.getbbox(ch), int(font.getlength(ch))), memoized per font and char."""
+    key = (id(font), ch)
+    res = _SHAPE_CACHE.get(key)
+    if res is None:
+        res = _SHAPE_CACHE[key] = (font.getbbox(ch), int(font.getlength(ch)))
+    return res
 
-    for ch in charset:
-        cp = ord(ch)
-        name, font = select_font(cp, fonts)
 
-        if font is None:
-            missing.append(ch)
-            continue
+def _rasterize(args):
+    """Worker: measure and draw one glyph with the font at `path`.
+    Returns (cp, w, h, xoff, yoff, xadv, png_bytes_or_None), or None if the
+    glyph is blank (space is kept as a zero-size entry)."""
+    ch, path, size, padding = args
+    font = _get_font(path, size)
 
-        if name != primary_name:
-            fallback_usage.setdefault(name, []).append(ch)
+    # Space only needs its advance: skip the bbox and drawing entirely
+    if ch == ' ':
+        return ord(ch), 0, 0, 0, 0, int(font.getlength(ch)), None
 
-        # Measure glyph
-        bbox = font.getbbox(ch)
-        if not bbox:
-            continue
-        l, t, r, b = bbox
-        w, h = r - l, b - t
-        adv = int(font.getlength(ch))
-
-        if w <= 0 or h <= 0:
-            if ch == ' ':
-                glyphs.append(dict(id=cp, w=0, h=0,
-                                   xoff=0, yoff=0, xadv=adv, img=None))
-            continue
+    # Measure glyph
+    bbox, adv = _shape(font, ch)
+    if not bbox:
+        return None
+    l, t, r, b = bbox
+    w, h = r - l, b - t
+    if w <= 0 or h <= 0:
+        return None
+
+    # Render glyph into a padded RGBA image; PNG keeps the IPC payload small
+    pw, ph = w + 2 * padding, h + 2 * padding
+    img = Image.new('RGBA', (pw, ph), (0, 0, 0, 0))
+    ImageDraw.Draw(img).text((padding - l, padding - t), ch,
+                             font=font, fill=(255, 255, 255, 255))
+    buf = BytesIO()
+    img.save(buf, 'PNG', compress_level=1)
+    return ord(ch), pw, ph, l - padding, t - padding, adv, buf.getvalue()
+
+
+def render_glyphs(fonts, charset):
+    """Render each character with the first font that covers it,
+    rasterizing in a pool of RENDER_WORKERS processes.
+    Returns (glyphs: CHAR_DTYPE array sorted by id, imgs: list[ndarray | None],
+    each image an (h, w, 4) uint8 RGBA array) ready for atlas packing;
+    x/y/page are filled in by pack_glyphs."""
+    tasks = []
+    missing = []
+    fallback_usage = {}           # font_name → [chars] (non-primary only)
+    primary_name, _, primary_cmap = fonts[0]
+    primary_path = FONT_FILES[primary_name]
+    fallbacks = fonts[1:]
 
-        # Render glyph into a padded RGBA image
-        pw, ph = w + 2 * PADDING, h + 2 * PADDING
-        img = Image.new('RGBA', (pw, ph), (0, 0, 0, 0))
-        ImageDraw.Draw(img).text((PADDING - l, PADDING - t), ch,
-                                 font=font, fill=(255, 255, 255, 255))
-        glyphs.append(dict(id=cp, w=pw, h=ph,
-                           xoff=l - PADDING, yoff=t - PADDING,
-                           xadv=adv, img=img))
+    for ch in charset:
+        # Pick the first font covering `ch` (cmap None → fontTools unavailable, try blindly)
+        if primary_cmap is None or ord(ch) in primary_cmap:
+            path = primary_path
+        else:
+            for name, _, cmap in fallbacks:
+                if cmap is None or ord(ch) in cmap:
+                    fallback_usage.setdefault(name, []).append(ch)
+                    path = FONT_FILES[name]
+                    break
+            else:
+                missing.append(ch)
+                continue
+        tasks.append((ch, path, FONT_SIZE, PADDING))
+
+    rows, imgs = [], []
+    with ProcessPoolExecutor(RENDER_WORKERS) as executor:
+        for res in executor.map(_rasterize, tasks, chunksize=128):
+            if res is None:
+                continue
+            cp, pw, ph, xoff, yoff, adv, png = res
+            rows.append((cp, 0, 0, pw, ph, xoff, yoff, adv, 0, 15))
+            imgs.append(np.asarray(Image.open(BytesIO(png))) if png else None)
 
     # ── Report ──
     for name, chars in fallback_usage.items():
@@ -154,55 +222,225 @@ def render_glyphs(fonts, charset):
             print(f"      ... and {len(missing) - 30} more")
         print("  → Add a fallback font or remove these characters from source data.")
 
-    return glyphs
+    return np.array(rows, dtype=CHAR_DTYPE), imgs
 
 
 # ── Atlas Packing ─────────────────────────────────────────────────
-def pack_glyphs(glyphs):
-    """Shelf-pack rendered glyphs into texture atlas pages.
-    Returns (pages: list[Image], entries: list[dict])."""
-    pages, entries = [], []
-    page = Image.new('RGBA', (TEX_W, TEX_H), (0, 0, 0, 0))
-    pi = x = y = row_h = 0
-
-    for g in glyphs:
-        if g['img'] is None:
-            entries.append(dict(id=g['id'], x=0, y=0, w=0, h=0,
-                                xoff=0, yoff=0, xadv=g['xadv'], page=0, chnl=15))
+class ShelfPacker:
+    """Best-fit shelf packer for one atlas page: each glyph goes onto the
+    shortest open shelf that fits, else a new shelf is opened below."""
+
+    def __init__(self, w, h):
+        self.w, self.h = w, h
+        self.shelves = []         # [x, y, h] per open shelf
+        self.y = 0
+
+    def insert(self, gw, gh):
+        """Return (x, y) for a gw×gh rect, or None if the page is full."""
+        best = None
+        for shelf in self.shelves:
+            if shelf[2] >= gh and shelf[0] + gw <= self.w and (best is None or shelf[2] < best[2]):
+                best = shelf
+        if best is None:
+            if self.y + gh > self.h or gw > self.w:
+                return None
+            best = [0, self.y, gh]
+            self.shelves.append(best)
+            self.y += gh
+        x = best[0]
+        best[0] = x + gw
+        return x, best[1]
+
+
+class MaxRectsPacker:
+    """MaxRects packer (Best Short Side Fit) for one atlas page.
+    Keeps every maximal free rectangle, so space below tall glyphs stays usable."""
+
+    def __init__(self, w, h):
+        self.free_rects = [(0, 0, w, h)]
+
+    def insert(self, gw, gh):
+        """Return (x, y) for a gw×gh rect, or None if the page is full."""
+        best = best_short = best_long = None
+        for fx, fy, fw, fh in self.free_rects:
+            if fw >= gw and fh >= gh:
+                dw, dh = fw - gw, fh - gh
+                short, long = min(dw, dh), max(dw, dh)
+                if best is None or short < best_short or (short == best_short and long < best_long):
+                    best, best_short, best_long = (fx, fy), short, long
+        if best is None:
+            return None
+        self._split(best[0], best[1], gw, gh)
+        return best
+
+    def _split(self, x, y, w, h):
+        """Carve the placed rect out of every free rect it overlaps, then prune."""
+        out = []
+        for fx, fy, fw, fh in self.free_rects:
+            if x >= fx + fw or x + w <= fx or y >= fy + fh or y + h <= fy:
+                out.append((fx, fy, fw, fh))
+                continue
+            if x > fx:
+                out.append((fx, fy, x - fx, fh))
+            if x + w < fx + fw:
+                out.append((x + w, fy, fx + fw - x - w, fh))
+            if y > fy:
+                out.append((fx, fy, fw, y - fy))
+            if y + h < fy + fh:
+                out.append((fx, y + h, fw, fy + fh - y - h))
+
+        # Prune free rects fully contained in another one
+        out.sort(key=lambda r: r[2] * r[3], reverse=True)
+        kept = []
+        for r in out:
+            rx, ry, rw, rh = r
+            if not any(kx <= rx and ky <= ry and rx + rw <= kx + kw and ry + rh <= ky + kh
+                       for kx, ky, kw, kh in kept):
+                kept.append(r)
+        self.free_rects = kept
+
+
+def _mr_best_fit(free, n, gw, gh):
+    """Index of the Best Short Side Fit rect in free[:n] for a gw×gh glyph, or -1."""
+    best, best_short, best_long = -1, 1 << 30, 1 << 30
+    for i in range(n):
+        dw, dh = free[i, 2] - gw, free[i, 3] - gh
+        if dw >= 0 and dh >= 0:
+            short, long = min(dw, dh), max(dw, dh)
+            if short < best_short or (short == best_short and long < best_long):
+                best, best_short, best_long = i, short, long
+    return best
+
+
+def _mr_split_and_prune(free, n, x, y, w, h):
+    """Array form of MaxRectsPacker._split: returns (new_free, new_n)."""
+    out = np.empty((4 * n, 4), np.int32)
+    m = 0
+    for i in range(n):
+        fx, fy, fw, fh = free[i, 0], free[i, 1], free[i, 2], free[i, 3]
+        if x >= fx + fw or x + w <= fx or y >= fy + fh or y + h <= fy:
+            out[m] = free[i]
+            m += 1
             continue
-
-        gw, gh = g['w'], g['h']
-
-        # Wrap to next row
-        if x + gw > TEX_W:
-            x, y, row_h = 0, y + row_h, 0
+        if x > fx:
+            out[m, 0], out[m, 1], out[m, 2], out[m, 3] = fx, fy, x - fx, fh
+            m += 1
+        if x + w < fx + fw:
+            out[m, 0], out[m, 1], out[m, 2], out[m, 3] = x + w, fy, fx + fw - x - w, fh
+            m += 1
+        if y > fy:
+            out[m, 0], out[m, 1], out[m, 2], out[m, 3] = fx, fy, fw, y - fy
+            m += 1
+        if y + h < fy + fh:
+            out[m, 0], out[m, 1], out[m, 2], out[m, 3] = fx, y + h, fw, fy + fh - y - h
+            m += 1
+
+    # Prune free rects fully contained in another one (largest first, stable)
+    area = out[:m, 2].astype(np.int64) * out[:m, 3]
+    kept = np.empty((m, 4), np.int32)
+    k = 0
+    for i in np.argsort(-area, kind='mergesort'):
+        rx, ry, rw, rh = out[i, 0], out[i, 1], out[i, 2], out[i, 3]
+        contained = False
+        for j in range(k):
+            if (kept[j, 0] <= rx and kept[j, 1] <= ry and
+                    rx + rw <= kept[j, 0] + kept[j, 2] and ry + rh <= kept[j, 1] + kept[j, 3]):
+                contained = True
+                break
+        if not contained:
+            kept[k] = out[i]
+            k += 1
+    return kept, k
+
+
+class NumbaMaxRectsPacker:
+    """MaxRectsPacker on an int32 (n, 4) free-rect array, with the scan and
+    split/prune loops compiled by numba. Places glyphs identically."""
+
+    def __init__(self, w, h):
+        self.free = np.array([[0, 0, w, h]], np.int32)
+        self.n = 1
+
+    def insert(self, gw, gh):
+        """Return (x, y) for a gw×gh rect, or None if the page is full."""
+        i = _mr_best_fit(self.free, self.n, gw, gh)
+        if i < 0:
+            return None
+        x, y = int(self.free[i, 0]), int(self.free[i, 1])
+        self.free, self.n = _mr_split_and_prune(self.free, self.n, x, y, gw, gh)
+        return x, y
+
+
+if njit is not None:
+    _mr_best_fit = njit(cache=True)(_mr_best_fit)
+    _mr_split_and_prune = njit(cache=True)(_mr_split_and_prune)
+
+PACKERS = {"shelf": ShelfPacker,
+           "maxrects": NumbaMaxRectsPacker if njit is not None else MaxRectsPacker}
+
+
+def pack_glyphs(glyphs, imgs):
+    """Pack rendered glyphs into texture atlas pages using the PACKER strategy.
+    Glyph rects never overlap and pages start transparent, so each glyph is
+    a plain array copy into the page buffer.
+    Returns (pages: list[ndarray (TEX_H, TEX_W, 4) RGBA], entries: CHAR_DTYPE
+    array in glyph order)."""
+    packer_cls = PACKERS[PACKER]
+    entries = glyphs.copy()
+    ws, hs = entries['w'].tolist(), entries['h'].tolist()
+    xs, ys, pis = [0] * len(entries), [0] * len(entries), [0] * len(entries)
+    pages = []
+    page = np.zeros((TEX_H, TEX_W, 4), np.uint8)
+    packer = packer_cls(TEX_W, TEX_H)
+    pi = 0
+
+    # Tallest first (ties: widest first) suits both packers
+    for i in np.lexsort((entries['id'], -entries['w'].astype(np.int32),
+                         -entries['h'].astype(np.int32))).tolist():
+        if imgs[i] is None:
+            continue                  # zero-size entry (space), keeps x=y=page=0
+
+        gw, gh = ws[i], hs[i]
+        pos = packer.insert(gw, gh)
 
         # Overflow to next page
-        if y + gh > TEX_H:
+        if pos is None:
             pages.append(page)
-            page = Image.new('RGBA', (TEX_W, TEX_H), (0, 0, 0, 0))
+            page = np.zeros((TEX_H, TEX_W, 4), np.uint8)
+            packer = packer_cls(TEX_W, TEX_H)
             pi += 1
-            x = y = row_h = 0
+            pos = packer.insert(gw, gh)
+            if pos is None:
+                raise ValueError(f"Glyph U+{int(entries['id'][i]):04X} ({gw}×{gh}) does not fit a "
+                                 f"{TEX_W}×{TEX_H} page")
 
-        page.paste(g['img'], (x, y))
-        entries.append(dict(id=g['id'], x=x, y=y, w=gw, h=gh,
-                            xoff=g['xoff'], yoff=g['yoff'], xadv=g['xadv'],
-                            page=pi, chnl=15))
-        x += gw
-        row_h = max(row_h, gh)
+        x, y = xs[i], ys[i] = pos
+        pis[i] = pi
+        page[y:y + gh, x:x + gw] = imgs[i]
 
     pages.append(page)
+    entries['x'], entries['y'], entries['page'] = xs, ys, pis
     return pages, entries
 
 
 # ── File Output ───────────────────────────────────────────────────
+def write_tga(path, page):
+    """Write an (h, w, 4) RGBA array as a 32-bit uncompressed TGA: BGRA pixels,
+    bottom-up rows, 8 alpha bits (the same bytes PIL's TGA encoder produces)."""
+    h, w = page.shape[:2]
+    with open(path, 'wb') as f:
+        f.write(TGA_HDR.pack(0, 0, 2, 0, 0, 0, 0, 0, w, h, 32, 8))
+        f.write(np.take(page[::-1], [2, 1, 0, 3], axis=2))   # RGBA → BGRA, one copy
+        f.write(TGA_FOOTER)
+
+
 def save_pages(pages):
     """Save atlas pages as 32-bit RGBA uncompressed TGA files."""
     names = []
-    for i, img in enumerate(pages):
+    for i, page in enumerate(pages):
         name = f"{PAGE_PREFIX}{i:02d}.tga"
         names.append(name)
-        img.save(os.path.join(OUTPUT_DIR, name))
+        write_tga(os.path.join(OUTPUT_DIR, name), page)
         print(f"  Saved {name} ({TEX_W}×{TEX_H})")
     return names
 
@@ -210,30 +448,28 @@ def save_pages(pages):
 def build_fnt(entries, page_names):
     """Serialize glyph data into BMFont v3 binary (.fnt) format."""
     def block(btype, data):
-        return struct.pack('<BI', btype, len(data)) + data
+        return BLOCK_HDR.pack(btype, len(data)) + data
 
     fnt = bytearray(b'BMF\x03')
 
     # Block 1 – Info
-    info = struct.pack('<hBBH8B', -FONT_SIZE, 0xC0, 0, 100,
-                       1, 1, 1, 1, 1, 1, 1, 0)
+    info = INFO_ST.pack(-FONT_SIZE, 0xC0, 0, 100,
+                        1, 1, 1, 1, 1, 1, 1, 0)
     info += FONT_NAME.encode('utf-8') + b'\x00'
     fnt += block(1, info)
 
     # Block 2 – Common
-    fnt += block(2, struct.pack('<5H5B',
+    fnt += block(2, COMMON_ST.pack(
         LINE_HEIGHT, BASE, TEX_W, TEX_H, len(page_names),
         0, 4, 0, 0, 0))
 
     # Block 3 – Page names (null-terminated)
     fnt += block(3, b''.join(n.encode('utf-8') + b'\x00' for n in page_names))
 
-    # Block 4 – Character entries (20 bytes each)
-    fnt += block(4, b''.join(
-        struct.pack('<IHHHHhhhBB',
-                    e['id'], e['x'], e['y'], e['w'], e['h'],
-                    e['xoff'], e['yoff'], e['xadv'], e['page'], e['chnl'])
-        for e in entries))
+    # Block 4 – Character entries (20 bytes each), copied straight from the array
+    chars = np.ascontiguousarray(entries, dtype=CHAR_DTYPE)
+    fnt += BLOCK_HDR.pack(4, chars.nbytes)
+    fnt += chars.data
 
     return bytes(fnt)
 
@@ -251,11 +487,11 @@ def generate():
     print(f"  {len(charset)} unique characters")
 
     print("\n── Rendering glyphs ──")
-    glyphs = render_glyphs(fonts, charset)
+    glyphs, imgs = render_glyphs(fonts, charset)
     print(f"  {len(glyphs)} glyphs rendered")
 
     print("\n── Packing atlas ──")
-    pages, entries = pack_glyphs(glyphs)
+    pages, entries = pack_glyphs(glyphs, imgs)
     print(f"  {len(pages)} page(s)")
 
     print("\n── Saving files ──")
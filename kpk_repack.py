@@ -7,7 +7,10 @@
 pip install lz4
 """
 
-import os, sys, struct, zlib, lz4.block
+import os, sys, json, mmap, struct, zlib, hashlib, lz4.block
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
 
 # ==================== 配置区 ====================
 KPK_PATH = r"C:\Program Files (x86)\Steam\steamapps\common\DIG\res\base.kpk"
@@ -15,12 +18,27 @@ KPK_PATH = r"C:\Program Files (x86)\Steam\steamapps\common\DIG\res\base.kpk"
 # 替换目录
 PATCH_FOLDERS = ["data", "font"]
 
+# 压缩结果缓存（程序所在目录下 .kpk_cache.json + .kpk_cache/），未改动的文件不再重复压缩
+CACHE_NAME = ".kpk_cache"
+
 # ================================================
 
 SIG        = b'KinoArchive\x01\x00'   # 13 字节文件头
 SIG_LEN    = len(SIG)
 HDR_LEN    = 23                        # 条目头固定部分
+ENTRY_HDR  = struct.Struct('<HQQBI')   # name_len, comp_size, decomp_size, flags, crc32
 CHUNK_SIZE = 8 * 1024 * 1024           # 分块拷贝 8 MB
+KCOPY_MIN  = 64 * 1024                 # 内核拷贝的最小步长，间隙更小时走用户态
+MMAP_MIN   = 16 * 1024 * 1024          # 不小于此大小的补丁文件用 mmap 读取
+CRC_CHUNK  = 1024 * 1024               # CRC32 分块大小 1 MB
+
+# 已压缩格式，LZ4 几乎无增益，直接原样存储（不尝试压缩）
+INCOMPRESSIBLE = {'.png', '.ogg', '.jpg', '.webp', '.mp3'}
+
+_copy_buf        = bytearray(CHUNK_SIZE)               # 用户态拷贝复用的缓冲区
+_use_kernel_copy = hasattr(os, 'copy_file_range')      # Linux: 内核内拷贝
+_hdr_buf         = bytearray(HDR_LEN)                  # 条目头复用缓冲区
+_has_writev      = hasattr(os, 'writev')               # POSIX: 多缓冲区一次写入
 
 
 # ─── 工具函数 ─────────────────────────────────────
@@ -36,29 +54,29 @@ def build_index(filepath):
     """
     扫描 KPK 文件，只读取每个条目的头部信息（不读文件体），
     返回 [{name, offset, total_size}, ...] 列表，按出现顺序排列。
+    整个文件 mmap 后按偏移解析条目头，不再逐条 read/seek。
     """
     entries = []
     with open(filepath, 'rb') as f:
-        sig = f.read(SIG_LEN)
-        if sig != SIG:
+        size = os.fstat(f.fileno()).st_size
+        if size < SIG_LEN:
             raise ValueError(f"KPK 签名不匹配: {filepath}")
-        while True:
-            offset = f.tell()
-            hdr = f.read(HDR_LEN)
-            if len(hdr) < HDR_LEN:
-                break
-            name_len, comp_size, _decomp_size = struct.unpack('<HQQ', hdr[:18])
-            # flags = hdr[18], crc = hdr[19:23] — 建索引时不需要
-            name_bytes = f.read(name_len)
-            if len(name_bytes) < name_len:
-                break
-            name = name_bytes.decode('utf-8')
-            f.seek(comp_size, os.SEEK_CUR)          # 跳过文件体
-            entries.append({
-                'name':       name,
-                'offset':     offset,                # 条目起始偏移
-                'total_size': HDR_LEN + name_len + comp_size,
-            })
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:SIG_LEN] != SIG:
+                raise ValueError(f"KPK 签名不匹配: {filepath}")
+            offset = SIG_LEN
+            while offset + HDR_LEN <= size:
+                # flags、crc 建索引时不需要
+                name_len, comp_size, _decomp_size, _flags, _crc = ENTRY_HDR.unpack_from(mm, offset)
+                name_end = offset + HDR_LEN + name_len
+                if name_end > size:
+                    break
+                entries.append({
+                    'name':       mm[offset + HDR_LEN:name_end].decode('utf-8'),
+                    'offset':     offset,            # 条目起始偏移
+                    'total_size': HDR_LEN + name_len + comp_size,
+                })
+                offset = name_end + comp_size        # 跳过文件体
     return entries
 
 
@@ -80,48 +98,305 @@ def collect_local_files(base_dir, folders):
     return result
 
 
+def crc32(buf):
+    """按 1 MB 分块计算 buf（bytes 或 mmap）的 CRC32，大文件只需少量页常驻。"""
+    crc = 0
+    with memoryview(buf) as mv:
+        for i in range(0, len(mv), CRC_CHUNK):
+            crc = zlib.crc32(mv[i:i + CRC_CHUNK], crc)
+    return crc & 0xFFFFFFFF
+
+
 def copy_block(f, src, dst, size):
     """
     在同一个文件内，把 [src, src+size) 拷贝到 [dst, dst+size)。
     要求 dst <= src（前向拷贝，分块处理，重叠安全）。
+    支持 os.copy_file_range 时在内核内完成拷贝（数据不经过用户态），
+    否则用复用缓冲区 readinto/write。
     """
+    global _use_kernel_copy
     if src == dst or size == 0:
         return
     copied = 0
+
+    # 同一文件内源/目标区间不能重叠，每次最多拷贝 src-dst 字节
+    step = min(CHUNK_SIZE, src - dst)
+    if _use_kernel_copy and step >= KCOPY_MIN:
+        f.flush()                                  # 清空 f 的读写缓冲，避免与内核写入不一致
+        fd = f.fileno()
+        try:
+            while copied < size:
+                n = os.copy_file_range(fd, fd, min(step, size - copied),
+                                       src + copied, dst + copied)
+                if n <= 0:
+                    break
+                copied += n
+        except OSError:
+            _use_kernel_copy = False               # 内核/文件系统不支持，此后全部走用户态
+
+    buf = memoryview(_copy_buf)
     while copied < size:
         n = min(CHUNK_SIZE, size - copied)
         f.seek(src + copied)
-        data = f.read(n)
+        f.readinto(buf[:n])
         f.seek(dst + copied)
-        f.write(data)
+        f.write(buf[:n])
         copied += n
 
 
-def write_new_entry(f, name, filepath):
+def plan_compaction(entries, is_affected):
+    """
+    生成紧缩计划: 按原顺序跳过受影响条目，保留条目依次前移。
+    中间没有被删条目的连续保留条目合并为一次移动。
+    返回 (moves=[(src, dst, size), ...], 紧缩后末尾偏移, 保留条目数)。
+    """
+    moves     = []
+    write_pos = SIG_LEN
+    kept      = 0
+    for entry in entries:
+        if is_affected(entry['name']):
+            continue                               # 跳过 = 删除
+        src = entry['offset']
+        sz  = entry['total_size']
+        if write_pos < src:
+            if moves and moves[-1][0] + moves[-1][2] == src:
+                last = moves[-1]                   # 与上一段相邻，合并
+                moves[-1] = (last[0], last[1], last[2] + sz)
+            else:
+                moves.append((src, write_pos, sz))
+        write_pos += sz
+        kept += 1
+    return moves, write_pos, kept
+
+
+def compress_file(name, filepath):
     """
-    读取磁盘文件，压缩（若有益），写入一个完整的 KPK 条目到 f 当前位置。
-    返回写入的字节数。
+    读取并压缩（若有益）一个补丁文件，可在子进程中运行。
+    大文件经 mmap 读取，由页缓存直接供数，不再额外复制一份到内存。
+    返回 (flags, crc, raw_size, comp)；comp 为 None 表示原样存储，
+    文件体由写入方直接从磁盘拷贝（避免经进程间管道传大文件），
+    crc 也由写入方边拷贝边计算，此处为 None。
     """
-    raw      = open(filepath, 'rb').read()
+    with open(filepath, 'rb') as g:
+        if os.fstat(g.fileno()).st_size >= MMAP_MIN:
+            with mmap.mmap(g.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return _compress(name, mm)
+        return _compress(name, g.read())
+
+
+def _compress(name, raw):
     raw_size = len(raw)
-    crc      = zlib.crc32(raw) & 0xFFFFFFFF
-    nb       = name.encode('utf-8')
-
-    if name.lower().endswith('.mp4'):
-        flags, body = 0x03, raw                     # mp4 原样存储
-    else:
-        comp = lz4.block.compress(raw, store_size=False)
-        if len(comp) < raw_size:
-            flags, body = 0x00, comp                # LZ4 压缩
-        else:
-            flags, body = 0x01, raw                 # 压缩无增益，原样存储
 
-    f.write(struct.pack('<HQQ', len(nb), len(body), raw_size))
-    f.write(struct.pack('<BI', flags, crc))
-    f.write(nb)
-    f.write(body)
+    ext = os.path.splitext(name)[1].lower()
+    if ext == '.mp4':
+        return 0x03, None, raw_size, None           # mp4 原样存储
+    if ext in INCOMPRESSIBLE:
+        return 0x01, None, raw_size, None           # 已压缩格式，原样存储
+    comp = lz4.block.compress(raw, store_size=False)
+    if len(comp) < raw_size:
+        return 0x00, crc32(raw), raw_size, comp     # LZ4 压缩
+    return 0x01, None, raw_size, None               # 压缩无增益，原样存储
 
-    return HDR_LEN + len(nb) + len(body)
+
+class CompressCache:
+    """
+    补丁文件压缩结果缓存。索引 <cache_dir>.json 记录
+    {磁盘绝对路径: [mtime_ns, size, flags, crc, 压缩体文件名, 压缩体长度, 压缩体 CRC]}
+    （原样存储的条目后三项为 null），压缩体存放在 cache_dir 下。
+    mtime 或大小变化即视为失效。压缩体文件名由路径、mtime、大小共同决定，
+    旧索引不会指向新版本的压缩体；读回时校验长度与 CRC，不符即视为未命中。
+    缓存只是加速手段：任何 OSError 都会让它在本次运行中停用，绝不外抛。
+    """
+
+    def __init__(self, cache_dir):
+        self.dir     = cache_dir
+        self.enabled = True
+        self.stats   = {}                             # 本次查询过的文件 → os.stat 结果
+        try:
+            with open(cache_dir + '.json', 'r', encoding='utf-8') as fp:
+                self.index = json.load(fp)
+        except (OSError, ValueError):
+            self.index = {}
+
+    def lookup(self, filepath):
+        """命中时返回与 compress_file 相同格式的结果，否则返回 None。"""
+        if not self.enabled:
+            return None
+        try:
+            st = self.stats[filepath] = os.stat(filepath)
+        except OSError as e:
+            self.disable(e)
+            return None
+        rec = self.index.get(filepath)
+        if (not rec or len(rec) != 7
+                or rec[0] != st.st_mtime_ns or rec[1] != st.st_size):
+            return None
+        _, raw_size, flags, crc, body, body_len, body_crc = rec
+        if body is None:
+            return flags, crc, raw_size, None
+        try:
+            with open(os.path.join(self.dir, body), 'rb') as g:
+                comp = g.read()
+        except OSError:
+            return None
+        if len(comp) != body_len or crc32(comp) != body_crc:
+            return None
+        return flags, crc, raw_size, comp
+
+    def store(self, filepath, packed):
+        """记录 filepath（须先 lookup 过）的压缩结果。"""
+        if not self.enabled:
+            return
+        flags, crc, raw_size, comp = packed
+        st   = self.stats[filepath]
+        body = body_len = body_crc = None
+        self.index.pop(filepath, None)
+        if comp is not None:
+            key  = f"{filepath}\0{st.st_mtime_ns}\0{st.st_size}"
+            body = hashlib.sha1(key.encode('utf-8')).hexdigest() + '.lz4'
+            body_len, body_crc = len(comp), crc32(comp)
+            body_path = os.path.join(self.dir, body)
+            try:
+                os.makedirs(self.dir, exist_ok=True)
+                with open(body_path + '.tmp', 'wb') as g:
+                    g.write(comp)
+                os.replace(body_path + '.tmp', body_path)   # 写完整才换上，不留半截压缩体
+            except OSError as e:
+                try:
+                    os.remove(body_path + '.tmp')
+                except OSError:
+                    pass
+                self.disable(e)
+                return
+        self.index[filepath] = [st.st_mtime_ns, st.st_size, flags, crc,
+                                body, body_len, body_crc]
+
+    def disable(self, err):
+        """停用缓存，本次运行余下部分直接压缩。"""
+        print(f"      ⚠ 压缩缓存不可用，已停用: {err}", flush=True)
+        self.enabled = False
+
+    def save(self):
+        """
+        写回索引；本次未用到的条目，以及索引不再引用的压缩体
+        （旧版本、中断运行留下的临时文件）一并清除。缓存已停用时不写。
+        """
+        if not self.enabled:
+            return
+        for filepath in [p for p in self.index if p not in self.stats]:
+            del self.index[filepath]
+        live = {rec[4] for rec in self.index.values()}
+        try:
+            names = os.listdir(self.dir)
+        except OSError:
+            names = []
+        for body in names:
+            if body not in live:
+                try:
+                    os.remove(os.path.join(self.dir, body))
+                except OSError:
+                    pass
+        with open(self.dir + '.json', 'w', encoding='utf-8') as fp:
+            json.dump(self.index, fp, ensure_ascii=False)
+
+
+def compress_ahead(items, cache=None):
+    """
+    按 items=[(name, filepath), ...] 的顺序产出 (name, filepath, compress_file 结果)。
+    进程池最多提前压缩 2×CPU 个文件，写入方顺序写盘的同时其余核在压缩。
+    给定 cache 时，命中缓存的文件不再压缩，新压缩的结果写入缓存。
+    """
+    it = iter(items)
+    with ProcessPoolExecutor() as executor:
+        def submit(name, path):
+            packed = cache.lookup(path) if cache is not None else None
+            if packed is None:
+                return name, path, executor.submit(compress_file, name, path), False
+            fut = Future()
+            fut.set_result(packed)
+            return name, path, fut, True
+
+        pending = deque(submit(name, path)
+                        for name, path in islice(it, 2 * (os.cpu_count() or 1)))
+        while pending:
+            name, path, fut, hit = pending.popleft()
+            for nxt_name, nxt_path in islice(it, 1):
+                pending.append(submit(nxt_name, nxt_path))
+            packed = fut.result()
+            if cache is not None and not hit:
+                cache.store(path, packed)
+            yield name, path, packed
+
+
+def write_parts(f, parts):
+    """
+    把若干缓冲区顺序写入 f 当前位置。POSIX 上先清空 f 的缓冲，
+    再用一次 os.writev 直接写 fd；其他平台多个小块拼接后一次 f.write。
+    """
+    if not _has_writev:
+        if len(parts) > 1 and sum(len(p) for p in parts) <= CHUNK_SIZE:
+            f.write(b''.join(parts))
+        else:
+            for p in parts:                         # 单块或大块不拼接，避免额外复制
+                f.write(p)
+        return
+
+    f.flush()
+    fd    = f.fileno()
+    total = sum(len(p) for p in parts)
+    n     = os.writev(fd, parts)
+    if n < total:                                   # 部分写入: 逐段补写剩余部分
+        for p in parts:
+            mv = memoryview(p)
+            if n >= len(mv):
+                n -= len(mv)
+                continue
+            mv, n = mv[n:], 0
+            while mv:
+                mv = mv[os.write(fd, mv):]
+
+
+def write_new_entry(f, name, filepath, packed):
+    """
+    把 compress_file 的结果 packed 写成一个完整的 KPK 条目到 f 当前位置。
+    压缩条目的头部、文件名、文件体合并为一次写入；
+    原样存储的条目从磁盘读取文件体并计算 CRC：不超过一块的一次读完、
+    一次写入；更大的分块拷贝，完成后按实际内容回填条目头。
+    文件在压缩后被改动也能保持条目自洽。返回写入的字节数。
+    """
+    flags, crc, raw_size, comp = packed
+    nb = name.encode('utf-8')
+
+    if comp is not None:
+        ENTRY_HDR.pack_into(_hdr_buf, 0, len(nb), len(comp), raw_size, flags, crc)
+        write_parts(f, [_hdr_buf, nb, comp])
+        return HDR_LEN + len(nb) + len(comp)
+
+    buf = memoryview(_copy_buf)
+    with open(filepath, 'rb') as g:
+        n = g.readinto(buf)
+        if n < CHUNK_SIZE:                          # 一块即读完
+            ENTRY_HDR.pack_into(_hdr_buf, 0, len(nb), n, n, flags, crc32(buf[:n]))
+            write_parts(f, [_hdr_buf, nb, buf[:n]])
+            return HDR_LEN + len(nb) + n
+
+        start = f.tell()
+        ENTRY_HDR.pack_into(_hdr_buf, 0, len(nb), 0, 0, flags, 0)   # 占位，拷贝完后回填
+        write_parts(f, [_hdr_buf, nb])
+        copied = 0
+        crc    = 0
+        while n:
+            crc = zlib.crc32(buf[:n], crc)
+            write_parts(f, [buf[:n]])
+            copied += n
+            n = g.readinto(buf)
+
+    end = start + HDR_LEN + len(nb) + copied
+    ENTRY_HDR.pack_into(_hdr_buf, 0, len(nb), copied, copied, flags, crc & 0xFFFFFFFF)
+    f.seek(start)                                   # 按实际拷贝的内容回填条目头
+    write_parts(f, [_hdr_buf])
+    f.seek(end)
+    return end - start
 
 
 # ─── 主流程 ───────────────────────────────────────
@@ -160,8 +435,10 @@ def patch():
     # ── 3. 分析差异 ──
     print(f"[3/5] 分析差异 ...")
 
+    prefixes = tuple(affected_prefixes)
+
     def is_affected(name):
-        return any(name.startswith(p) for p in affected_prefixes)
+        return name.startswith(prefixes)
 
     old_names = {e['name'] for e in entries if is_affected(e['name'])}
     new_names = set(local_files.keys())
@@ -218,29 +495,23 @@ def patch():
     # 原理: 按原顺序遍历全部条目，跳过被影响的条目，
     # 把保留条目依次前移。因为 write_pos ≤ entry.offset
     # 恒成立（只跳过从未增加），所以前向拷贝安全无重叠问题。
+    # 先生成移动计划，相邻条目合并成大段，按段拷贝。
     # ══════════════════════════════════════════════
     print(f"\n[4/5] 紧缩保留条目 ...")
 
-    with open(KPK_PATH, 'r+b') as f:
-        write_pos   = SIG_LEN
-        kept        = 0
+    moves, write_pos, kept = plan_compaction(entries, is_affected)
+    total_move = sum(sz for _, _, sz in moves)
+
+    with open(KPK_PATH, 'r+b', buffering=CHUNK_SIZE) as f:
         bytes_moved = 0
+        for i, (src, dst, sz) in enumerate(moves):
+            copy_block(f, src, dst, sz)
+            bytes_moved += sz
+            if (i + 1) % 2000 == 0:
+                print(f"      已处理 {i+1}/{len(moves)} 段 "
+                      f"(数据移动 {fmt_size(bytes_moved)}/{fmt_size(total_move)}) ...", flush=True)
 
-        for entry in entries:
-            if is_affected(entry['name']):
-                continue                           # 跳过 = 删除
-            src = entry['offset']
-            sz  = entry['total_size']
-            if write_pos < src:
-                copy_block(f, src, write_pos, sz)
-                bytes_moved += sz
-            write_pos += sz
-            kept += 1
-            if kept % 2000 == 0:
-                print(f"      已处理 {kept}/{unchanged_count} 保留条目 "
-                      f"(数据移动 {fmt_size(bytes_moved)}) ...", flush=True)
-
-        print(f"      保留 {kept} 个条目, 数据移动 {fmt_size(bytes_moved)}")
+        print(f"      保留 {kept} 个条目, {len(moves)} 段, 数据移动 {fmt_size(bytes_moved)}")
 
         # ══════════════════════════════════════════
         # Phase B: 追加新/修改条目
@@ -248,9 +519,11 @@ def patch():
         total_new = len(local_files)
         print(f"[5/5] 写入 {total_new} 个补丁条目 ...")
 
+        cache = CompressCache(os.path.join(script_dir, CACHE_NAME))
         f.seek(write_pos)
-        for i, (name, path) in enumerate(sorted(local_files.items())):
-            write_pos += write_new_entry(f, name, path)
+        for i, (name, path, packed) in enumerate(
+                compress_ahead(sorted(local_files.items()), cache)):
+            write_pos += write_new_entry(f, name, path, packed)
             if (i + 1) % 500 == 0:
                 print(f"      {i+1}/{total_new} ...", flush=True)
 
@@ -260,6 +533,12 @@ def patch():
         f.flush()
         f.truncate(write_pos)
 
+    # KPK 已完整落盘，缓存索引写失败只影响下次速度
+    try:
+        cache.save()
+    except OSError as e:
+        print(f"      ⚠ 压缩缓存索引写入失败: {e}")
+
     # ── 完成报告 ──
     new_size = write_pos
     diff     = new_size - original_size
@@ -3,7 +3,10 @@
 base.kpk 解压/压缩工具
 pip install lz4
 """
-import os, struct, zlib, lz4.block
+import os, mmap, struct, zlib, lz4.block
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 
 # ==================== 配置区 ====================
 MODE = 0  # 0=解压, 1=压缩
@@ -24,6 +27,18 @@ PACK_FOLDERS = ["data", "font", "image", "movie", "script", "shader", "sound"]
 #  crc32:  校验对象为解压后数据
 
 SIG = b'KinoArchive\x01\x00'
+MMAP_MIN   = 16 * 1024 * 1024   # 不小于此大小的文件用 mmap 读取
+CRC_CHUNK  = 1024 * 1024        # CRC32 分块大小
+CHUNK_SIZE = 8 * 1024 * 1024    # 原样存储时分块拷贝; 写文件缓冲区大小
+ENTRY_HDR  = struct.Struct('<HQQBI')
+INCOMPRESSIBLE = {'.png', '.ogg', '.jpg', '.webp', '.mp3'}   # 已压缩格式, 不尝试 LZ4 直接原样存储
+
+def crc32(buf):
+    crc = 0
+    with memoryview(buf) as mv:
+        for i in range(0, len(mv), CRC_CHUNK):
+            crc = zlib.crc32(mv[i:i + CRC_CHUNK], crc)
+    return crc & 0xFFFFFFFF
 
 def extract():
     with open(KPK_PATH, 'rb') as f:
@@ -46,6 +61,83 @@ def extract():
                 print(f"  已解压 {n} ...", flush=True)
     print(f"完成: {n} 个文件 → {EXTRACT_DIR}")
 
+def compress_file(name, path):
+    # 子进程中运行; 返回 (flags, crc, raw_size, comp), comp=None 表示原样存储(文件体和 crc 由写入方拷贝/计算)
+    with open(path, 'rb') as g:
+        if os.fstat(g.fileno()).st_size >= MMAP_MIN:
+            with mmap.mmap(g.fileno(), 0, access=mmap.ACCESS_READ) as raw:
+                return _compress(name, raw)
+        return _compress(name, g.read())
+
+def _compress(name, raw):
+    ext = os.path.splitext(name)[1].lower()
+    if ext == '.mp4':
+        return 0x03, None, len(raw), None
+    if ext in INCOMPRESSIBLE:
+        return 0x01, None, len(raw), None
+    comp = lz4.block.compress(raw, store_size=False)
+    if len(comp) < len(raw):
+        return 0x00, crc32(raw), len(raw), comp
+    return 0x01, None, len(raw), None
+
+def compress_ahead(files):
+    # 按顺序产出 (name, path, compress_file结果), 进程池最多提前压缩 2×CPU 个文件
+    it = iter(files)
+    with ProcessPoolExecutor() as ex:
+        pending = deque((n, p, ex.submit(compress_file, n, p))
+                        for n, p in islice(it, 2 * (os.cpu_count() or 1)))
+        while pending:
+            name, path, fut = pending.popleft()
+            for n, p in islice(it, 1):
+                pending.append((n, p, ex.submit(compress_file, n, p)))
+            yield name, path, fut.result()
+
+def write_parts(f, parts):
+    # POSIX: 清空 f 的缓冲后 os.writev 一次写入; 其他平台多个小块拼接后一次 f.write
+    if not hasattr(os, 'writev'):
+        if len(parts) > 1 and sum(len(p) for p in parts) <= CHUNK_SIZE:
+            f.write(b''.join(parts))
+        else:
+            for p in parts:
+                f.write(p)
+        return
+    f.flush()
+    n = os.writev(f.fileno(), parts)
+    for p in parts:                    # 部分写入时逐段补写剩余部分
+        mv = memoryview(p)
+        if n >= len(mv):
+            n -= len(mv)
+            continue
+        mv, n = mv[n:], 0
+        while mv:
+            mv = mv[os.write(f.fileno(), mv):]
+
+def write_entry(f, name, path, packed):
+    flags, crc, raw_size, comp = packed
+    nb = name.encode('utf-8')
+
+    if comp is not None:
+        write_parts(f, [ENTRY_HDR.pack(len(nb), len(comp), raw_size, flags, crc), nb, comp])
+        return
+    with open(path, 'rb') as g:    # 原样存储: 从磁盘读文件体, 边读边算 CRC
+        chunk = g.read(CHUNK_SIZE)
+        if len(chunk) < CHUNK_SIZE:    # 一块即读完, 一次写入
+            write_parts(f, [ENTRY_HDR.pack(len(nb), len(chunk), len(chunk), flags, crc32(chunk)),
+                            nb, chunk])
+            return
+        start = f.tell()
+        write_parts(f, [ENTRY_HDR.pack(len(nb), 0, 0, flags, 0), nb])   # 头部占位, 拷贝完后回填
+        size = crc = 0
+        while chunk:
+            crc = zlib.crc32(chunk, crc)
+            write_parts(f, [chunk])
+            size += len(chunk)
+            chunk = g.read(CHUNK_SIZE)
+    end = start + ENTRY_HDR.size + len(nb) + size
+    f.seek(start)                  # 按实际拷贝的内容回填条目头
+    write_parts(f, [ENTRY_HDR.pack(len(nb), size, size, flags, crc & 0xFFFFFFFF)])
+    f.seek(end)
+
 def pack():
     files = []
     for folder in PACK_FOLDERS:
@@ -59,26 +151,10 @@ def pack():
                 files.append((rel, full))
     files.sort()
 
-    with open(OUTPUT_KPK, 'wb') as f:
+    with open(OUTPUT_KPK, 'wb', buffering=CHUNK_SIZE) as f:
         f.write(SIG)
-        for i, (name, path) in enumerate(files):
-            raw = open(path, 'rb').read()
-            crc = zlib.crc32(raw) & 0xFFFFFFFF
-            nb = name.encode('utf-8')
-
-            if name.lower().endswith('.mp4'):
-                flags, body = 0x03, raw
-            else:
-                comp = lz4.block.compress(raw, store_size=False)
-                if len(comp) < len(raw):
-                    flags, body = 0x00, comp
-                else:
-                    flags, body = 0x01, raw
-
-            f.write(struct.pack('<HQQ', len(nb), len(body), len(raw)))
-            f.write(struct.pack('<BI', flags, crc))
-            f.write(nb)
-            f.write(body)
+        for i, (name, path, packed) in enumerate(compress_ahead(files)):
+            write_entry(f, name, path, packed)
             if (i + 1) % 500 == 0:
                 print(f"  已打包 {i+1}/{len(files)} ...", flush=True)
     print(f"完成: {len(files)} 个文件 → {OUTPUT_KPK}")